@@ -1,226 +1,323 @@
-from telegram import Update, Bot
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
+from telegram import Update
+from telegram.ext import AIORateLimiter, Application, ContextTypes, MessageHandler, filters
+from telegram.request import HTTPXRequest
+import asyncio
 import logging
 import os
-import re
+import sys
+from dataclasses import dataclass, field
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s', level=logging.WARNING)
 logger = logging.getLogger(__name__)
+# keep the bot's own startup messages while PTB's per-update INFO records stay suppressed
+logger.setLevel(logging.INFO)
+
+TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
+
+@dataclass(slots=True)
+class Game:
+    # list while players are joining, frozen to a (p0, p1) tuple once both have joined
+    players: list[int] | tuple[int, int] = field(default_factory=list)
+    player_set: frozenset[int] = frozenset()
+    player_names: dict[int, str] = field(default_factory=dict)
+    # user_id -> encode_secret(secret) or None until set
+    secrets: dict[int, tuple[int, int] | None] = field(default_factory=dict)
+    secrets_set: int = 0
+    turn_index: int = 0
+    finished: bool = False
 
 # In-memory games storage
 # Key: group_chat_id
-# Value: dict with keys: 'players' (list of user_id), 'player_names' (map id->name), 'secrets' (map id->secret or None), 'turn_index' (0/1), 'finished'
+# Value: Game
 GAMES = {}
 
-SECRET_RE = re.compile(r'^[1-9](?!.*\1)[1-9](?!.*\2)[1-9](?!.*\3)[1-9](?!.*\4)$')
-# More explicit: we will validate programmatically ensuring 4 digits, each 1-9, no repeats
+# Secondary index of the games each user has joined, so secret() doesn't scan GAMES
+# Key: user_id, Value: dict of group_chat_id -> None (keeps join order)
+USER_GAMES = {}
+
+# Per-chat locks serialising the read-check-mutate sections of the handlers
+# Key: group_chat_id, Value: asyncio.Lock
+GAME_LOCKS = {}
+
+DIGITS = "123456789"
+_VALID_CHARSET = frozenset(DIGITS)
 
 def valid_secret(num: str) -> bool:
-    if not num.isdigit() or len(num) != 4:
-        return False
-    digits = list(num)
-    if '0' in digits:
-        return False
-    if len(set(digits)) != 4:
-        return False
-    return True
-
-def compare_guess(secret: str, guess: str):
-    # returns (values, positions)
-    values = sum(1 for d in guess if d in secret)
-    positions = sum(1 for i in range(4) if guess[i] == secret[i])
-    return values, positions
+    # 4 digits, each 1-9, no repeats
+    return len(num) == 4 and _VALID_CHARSET.issuperset(num) and len(set(num)) == 4
+
+def encode_secret(num: str) -> tuple[int, int]:
+    # packs the digits one per nibble (e.g. '4567' -> 0x4567) plus a 9-bit mask of which digits occur
+    packed = int(num, 16)
+    mask = 0
+    for d in num:
+        mask |= 1 << (int(d) - 1)
+    return packed, mask
+
+def compare_guess(secret: tuple[int, int], guess: tuple[int, int]):
+    # both arguments come from encode_secret()
+    # returns (values, positions, comma-separated digits in the correct position or 'none')
+    secret_packed, secret_mask = secret
+    guess_packed, guess_mask = guess
+    values = (secret_mask & guess_mask).bit_count()
+    # a nibble of x is zero iff the digits at that position match; set bit 3 of each zero nibble
+    x = secret_packed ^ guess_packed
+    zero_nibbles = ~(((x & 0x7777) + 0x7777) | x | 0x7777) & 0x8888
+    positions = zero_nibbles.bit_count()
+    if not positions:
+        return values, positions, 'none'
+    pos_digits = [str(guess_packed >> shift & 0xF) for shift in (12, 8, 4, 0) if zero_nibbles >> shift & 0x8]
+    return values, positions, ','.join(pos_digits)
+
+def forget_players(chat_id: int, game: Game):
+    # drop this game from each player's USER_GAMES entry once it is over
+    for pid in game.players:
+        user_games = USER_GAMES.get(pid)
+        if user_games is None:
+            continue
+        user_games.pop(chat_id, None)
+        if not user_games:
+            del USER_GAMES[pid]
+
+def game_lock(chat_id: int) -> asyncio.Lock:
+    return GAME_LOCKS.setdefault(chat_id, asyncio.Lock())
 
 # --- Command handlers ---
 
-def start(update: Update, context: CallbackContext):
-    update.message.reply_text("Hi! I'm the NVP bot. Use /newgame in a group to start a 2-player NVP game.")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Hi! I'm the NVP bot. Use /newgame in a group to start a 2-player NVP game.")
 
 
-def newgame(update: Update, context: CallbackContext):
+async def newgame(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     if chat.type == 'private':
-        update.message.reply_text("Please run /newgame in a GROUP chat where you want to play.")
+        await update.message.reply_text("Please run /newgame in a GROUP chat where you want to play.")
         return
     chat_id = chat.id
-    if chat_id in GAMES and not GAMES[chat_id].get('finished', True):
-        update.message.reply_text("A game is already active in this group. Use /cancel to cancel it.")
-        return
-    GAMES[chat_id] = {
-        'players': [],
-        'player_names': {},
-        'secrets': {},
-        'turn_index': 0,
-        'finished': False
-    }
-    update.message.reply_text("New NVP game created! Players: 0/2. Join with /join")
+    async with game_lock(chat_id):
+        if chat_id in GAMES and not GAMES[chat_id].finished:
+            await update.message.reply_text("A game is already active in this group. Use /cancel to cancel it.")
+            return
+        GAMES[chat_id] = Game()
+        await update.message.reply_text("New NVP game created! Players: 0/2. Join with /join")
 
 
-def join(update: Update, context: CallbackContext):
+async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user
     if chat.type == 'private':
-        update.message.reply_text("You must join from the group chat where /newgame was used.")
+        await update.message.reply_text("You must join from the group chat where /newgame was used.")
         return
     chat_id = chat.id
-    if chat_id not in GAMES or GAMES[chat_id].get('finished', True):
-        update.message.reply_text("No active game here. Start one with /newgame")
-        return
-    game = GAMES[chat_id]
-    if user.id in game['players']:
-        update.message.reply_text("You already joined the game.")
-        return
-    if len(game['players']) >= 2:
-        update.message.reply_text("Game already has 2 players.")
-        return
-    game['players'].append(user.id)
-    game['player_names'][user.id] = user.first_name
-    game['secrets'][user.id] = None
-    update.message.reply_text(f"{user.first_name} joined the game! Players: {len(game['players'])}/2")
-    if len(game['players']) == 2:
-        p1 = game['player_names'][game['players'][0]]
-        p2 = game['player_names'][game['players'][1]]
-        update.message.reply_text(f"Two players joined: {p1} and {p2}.\nEach player, DM me your secret with /secret <4-digit> (digits 1-9, no repeats, no 0).")
+    async with game_lock(chat_id):
+        if chat_id not in GAMES or GAMES[chat_id].finished:
+            await update.message.reply_text("No active game here. Start one with /newgame")
+            return
+        game = GAMES[chat_id]
+        if user.id in game.player_set:
+            await update.message.reply_text("You already joined the game.")
+            return
+        if len(game.players) >= 2:
+            await update.message.reply_text("Game already has 2 players.")
+            return
+        game.players.append(user.id)
+        if len(game.players) == 2:
+            game.players = tuple(game.players)
+        game.player_set = frozenset(game.players)
+        game.player_names[user.id] = user.first_name
+        game.secrets[user.id] = None
+        USER_GAMES.setdefault(user.id, {})[chat_id] = None
+        parts = [f"{user.first_name} joined the game! Players: {len(game.players)}/2"]
+        if len(game.players) == 2:
+            p1 = game.player_names[game.players[0]]
+            p2 = game.player_names[game.players[1]]
+            parts.append(f"Two players joined: {p1} and {p2}.\nEach player, DM me your secret with /secret <4-digit> (digits 1-9, no repeats, no 0).")
+        await update.message.reply_text("\n".join(parts))
 
 
-def secret(update: Update, context: CallbackContext):
+async def secret(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # This must be sent in private chat to the bot
     chat = update.effective_chat
     user = update.effective_user
     if chat.type != 'private':
-        update.message.reply_text("Send your secret privately to me. Use /secret <4-digit> in a private chat with the bot.")
+        await update.message.reply_text("Send your secret privately to me. Use /secret <4-digit> in a private chat with the bot.")
         return
     if len(context.args) != 1:
-        update.message.reply_text("Usage: /secret 4567")
+        await update.message.reply_text("Usage: /secret 4567")
         return
     num = context.args[0].strip()
     if not valid_secret(num):
-        update.message.reply_text("Invalid secret. It must be 4 digits long, digits 1-9, no repeats, no 0. Example: 4567")
+        await update.message.reply_text("Invalid secret. It must be 4 digits long, digits 1-9, no repeats, no 0. Example: 4567")
         return
     # Find an active game where this user is a player and their secret is not yet set
     games_for_user = []
-    for gid, g in GAMES.items():
-        if user.id in g.get('players', []) and not g.get('finished', True) and g['secrets'].get(user.id) is None:
+    for gid in USER_GAMES.get(user.id, ()):
+        g = GAMES.get(gid)
+        if g and not g.finished and g.secrets.get(user.id) is None:
             games_for_user.append((gid, g))
-    if not games_for_user:
-        update.message.reply_text("Could not find an active game where you need to set a secret. Make sure you joined a group game and the game is active.")
-        return
-    # If multiple, choose the most recent one (first in dict iteration)
-    gid, game = games_for_user[0]
-    game['secrets'][user.id] = num
-    update.message.reply_text(f"Secret for game in group {gid} saved. Do not reveal it to your opponent.")
-    # If both secrets set, announce in group
-    if all(game['secrets'].get(pid) for pid in game['players']):
-        chat_title = context.bot.get_chat(gid).title or str(gid)
-        p1 = game['player_names'][game['players'][0]]
-        p2 = game['player_names'][game['players'][1]]
-        context.bot.send_message(chat_id=gid, text=f"Both players have set their secrets. Game between {p1} and {p2} starts now! {p1} goes first. Make a guess with /guess <4-digit>.")
-
-
-def guess(update: Update, context: CallbackContext):
+    # If multiple, choose the oldest joined one
+    for gid, game in games_for_user:
+        async with game_lock(gid):
+            # the game may have been cancelled or finished while waiting for the lock; try the next one
+            if GAMES.get(gid) is not game or game.finished or game.secrets.get(user.id) is not None:
+                continue
+            game.secrets[user.id] = encode_secret(num)
+            game.secrets_set += 1
+            await update.message.reply_text(f"Secret for game in group {gid} saved. Do not reveal it to your opponent.")
+            # If both secrets set, announce in group
+            if game.secrets_set == 2:
+                p1 = game.player_names[game.players[0]]
+                p2 = game.player_names[game.players[1]]
+                await context.bot.send_message(chat_id=gid, text=f"Both players have set their secrets. Game between {p1} and {p2} starts now! {p1} goes first. Make a guess with /guess <4-digit>.")
+            return
+    await update.message.reply_text("Could not find an active game where you need to set a secret. Make sure you joined a group game and the game is active.")
+
+
+async def guess(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     user = update.effective_user
     if chat.type == 'private':
-        update.message.reply_text("You should make guesses in the GROUP chat where the game is happening.")
+        await update.message.reply_text("You should make guesses in the GROUP chat where the game is happening.")
         return
     chat_id = chat.id
-    if chat_id not in GAMES or GAMES[chat_id].get('finished', True):
-        update.message.reply_text("No active game in this group. Start one with /newgame")
-        return
-    game = GAMES[chat_id]
-    if user.id not in game['players']:
-        update.message.reply_text("You are not a player in the current game.")
-        return
-    if len(context.args) != 1:
-        update.message.reply_text("Usage: /guess 7364")
-        return
-    guess_num = context.args[0].strip()
-    if not valid_secret(guess_num):
-        update.message.reply_text("Invalid guess. It must be 4 digits long, digits 1-9, no repeats, no 0.")
-        return
-    # Check both secrets set
-    if not all(game['secrets'].get(pid) for pid in game['players']):
-        update.message.reply_text("Waiting for both players to privately set their secrets with /secret.")
-        return
-    # Check turn
-    current_player_id = game['players'][game['turn_index']]
-    if user.id != current_player_id:
-        cur_name = game['player_names'][current_player_id]
-        update.message.reply_text(f"It's not your turn. It's {cur_name}'s turn.")
-        return
-    # Determine opponent
-    opponent_id = [pid for pid in game['players'] if pid != user.id][0]
-    opponent_name = game['player_names'][opponent_id]
-    opponent_secret = game['secrets'][opponent_id]
-    values, positions = compare_guess(opponent_secret, guess_num)
-    # Which digits are in correct positions? list them
-    correct_pos_digits = [guess_num[i] for i in range(4) if guess_num[i] == opponent_secret[i]]
-    pos_digits_str = ','.join(correct_pos_digits) if correct_pos_digits else 'none'
-    update.message.reply_text(f"{user.first_name} guessed {guess_num} → values={values}, positions={positions} (correct position digits: {pos_digits_str})")
-    if positions == 4:
-        update.message.reply_text(f"{user.first_name} guessed the secret of {opponent_name} and wins the game! 🎉")
-        game['finished'] = True
-        return
-    # advance turn
-    game['turn_index'] = 1 - game['turn_index']
-    next_player = game['player_names'][game['players'][game['turn_index']]]
-    update.message.reply_text(f"Now it's {next_player}'s turn.")
+    async with game_lock(chat_id):
+        if chat_id not in GAMES or GAMES[chat_id].finished:
+            await update.message.reply_text("No active game in this group. Start one with /newgame")
+            return
+        game = GAMES[chat_id]
+        if user.id not in game.player_set:
+            await update.message.reply_text("You are not a player in the current game.")
+            return
+        if len(context.args) != 1:
+            await update.message.reply_text("Usage: /guess 7364")
+            return
+        guess_num = context.args[0].strip()
+        if not valid_secret(guess_num):
+            await update.message.reply_text("Invalid guess. It must be 4 digits long, digits 1-9, no repeats, no 0.")
+            return
+        # Check both secrets set
+        if game.secrets_set != 2:
+            await update.message.reply_text("Waiting for both players to privately set their secrets with /secret.")
+            return
+        # Check turn
+        current_player_id = game.players[game.turn_index]
+        if user.id != current_player_id:
+            cur_name = game.player_names[current_player_id]
+            await update.message.reply_text(f"It's not your turn. It's {cur_name}'s turn.")
+            return
+        # Determine opponent
+        opponent_id = game.players[0] if user.id == game.players[1] else game.players[1]
+        opponent_name = game.player_names[opponent_id]
+        opponent_encoded = game.secrets[opponent_id]
+        values, positions, pos_digits_str = compare_guess(opponent_encoded, encode_secret(guess_num))
+        # collect the result and follow-up lines into a single message
+        parts = [f"{user.first_name} guessed {guess_num} → values={values}, positions={positions} (correct position digits: {pos_digits_str})"]
+        next_turn_index = 1 - game.turn_index
+        if positions == 4:
+            parts.append(f"{user.first_name} guessed the secret of {opponent_name} and wins the game! 🎉")
+        else:
+            next_player = game.player_names[game.players[next_turn_index]]
+            parts.append(f"Now it's {next_player}'s turn.")
+        # reply before changing state, so a failed send doesn't use up the turn or end the game silently
+        await update.message.reply_text("\n".join(parts))
+        if positions == 4:
+            game.finished = True
+            forget_players(chat_id, game)
+        else:
+            # advance turn
+            game.turn_index = next_turn_index
 
 
-def status(update: Update, context: CallbackContext):
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     if chat.type == 'private':
-        update.message.reply_text("Use /status in the group where the game is running to see game status.")
+        await update.message.reply_text("Use /status in the group where the game is running to see game status.")
         return
     chat_id = chat.id
     if chat_id not in GAMES:
-        update.message.reply_text("No game here.")
+        await update.message.reply_text("No game here.")
         return
     game = GAMES[chat_id]
-    if game.get('finished', False):
-        update.message.reply_text("No active game (finished). Start a new one with /newgame")
+    if game.finished:
+        await update.message.reply_text("No active game (finished). Start a new one with /newgame")
         return
-    players = [game['player_names'][pid] for pid in game['players']]
-    secrets_set = sum(1 for pid in game['players'] if game['secrets'].get(pid))
-    update.message.reply_text(f"Players: {players}. Secrets set: {secrets_set}/2. Next turn index: {game['turn_index']}")
+    players = [game.player_names[pid] for pid in game.players]
+    await update.message.reply_text(f"Players: {players}. Secrets set: {game.secrets_set}/2. Next turn index: {game.turn_index}")
 
 
-def cancel(update: Update, context: CallbackContext):
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     if chat.type == 'private':
-        update.message.reply_text("Use /cancel in the group to cancel the active game there.")
+        await update.message.reply_text("Use /cancel in the group to cancel the active game there.")
         return
     chat_id = chat.id
-    if chat_id not in GAMES:
-        update.message.reply_text("No active game to cancel.")
-        return
-    GAMES.pop(chat_id, None)
-    update.message.reply_text("Game cancelled.")
+    async with game_lock(chat_id):
+        if chat_id not in GAMES:
+            await update.message.reply_text("No active game to cancel.")
+            return
+        game = GAMES.pop(chat_id)
+        forget_players(chat_id, game)
+        await update.message.reply_text("Game cancelled.")
 
 
-def help_cmd(update: Update, context: CallbackContext):
-    update.message.reply_text("Commands (group): /newgame /join /guess <4-digit> /status /cancel\nCommands (private to bot): /secret <4-digit>")
+async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Commands (group): /newgame /join /guess <4-digit> /status /cancel\nCommands (private to bot): /secret <4-digit>")
+
+
+COMMANDS = {
+    'start': start,
+    'newgame': newgame,
+    'join': join,
+    'secret': secret,
+    'guess': guess,
+    'status': status,
+    'cancel': cancel,
+    'help': help_cmd,
+}
+
+
+async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # single entry point for all commands: one dict lookup instead of one CommandHandler per command
+    message = update.effective_message
+    # the command is the leading bot_command entity, e.g. '/guess' in '/guess,1234'
+    command_length = message.entities[0].length
+    command, _, bot_name = message.text[1:command_length].partition('@')
+    # ignore commands addressed to another bot, e.g. /join@OtherBot
+    if bot_name and bot_name.lower() != context.bot.username.lower():
+        return
+    handler = COMMANDS.get(command.lower())
+    if handler is None:
+        return
+    # MessageHandler doesn't parse arguments like CommandHandler does
+    context.args = message.text[command_length:].split()
+    await handler(update, context)
 
 
 def main():
-    TOKEN = '8266984728:AAHEAjQySxKR53dZm7oCnXEh6mSi993Vh6s'
-    if TOKEN == 'REPLACE_WITH_YOUR_BOT_TOKEN':
-        logger.warning('No TELEGRAM_BOT_TOKEN set; be sure to set it or replace the placeholder in code before running.')
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
-
-    dp.add_handler(CommandHandler('start', start))
-    dp.add_handler(CommandHandler('newgame', newgame))
-    dp.add_handler(CommandHandler('join', join))
-    dp.add_handler(CommandHandler('secret', secret))
-    dp.add_handler(CommandHandler('guess', guess))
-    dp.add_handler(CommandHandler('status', status))
-    dp.add_handler(CommandHandler('cancel', cancel))
-    dp.add_handler(CommandHandler('help', help_cmd))
-
-    updater.start_polling()
+    if not TOKEN:
+        logger.error('TELEGRAM_BOT_TOKEN not set')
+        sys.exit(1)
+    # queue outgoing messages within Telegram's global (30/s) and per-group (20/min) limits
+    rate_limiter = AIORateLimiter(overall_max_rate=30, group_max_rate=20)
+    # share pooled HTTP/2 connections between handlers; getUpdates gets its own client so
+    # the long poll never holds up a connection needed for sending
+    request = HTTPXRequest(connection_pool_size=256, http_version='2', read_timeout=30, write_timeout=30)
+    get_updates_request = HTTPXRequest(http_version='2')
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(rate_limiter)
+        # handle updates from different chats in parallel; game_lock() keeps each chat serialised
+        .concurrent_updates(True)
+        .build()
+    )
+
+    app.add_handler(MessageHandler(filters.COMMAND & filters.UpdateType.MESSAGE, dispatch))
+
     logger.info('NVP bot started. Polling...')
-    updater.idle()
+    app.run_polling(timeout=30)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file